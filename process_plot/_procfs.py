@@ -0,0 +1,119 @@
+"""Read process statistics directly from the Linux ``/proc`` filesystem.
+
+This is used in place of psutil on Linux,
+to sample a process with a single file read per poll.
+"""
+
+import os
+import resource
+from typing import NamedTuple, Optional
+
+import psutil
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class ProcStat(NamedTuple):
+    """Statistics for a process, from ``/proc/<pid>/stat``."""
+
+    state: str
+    cpu_time_user: float
+    cpu_time_sys: float
+    num_threads: int
+    memory_rss: int
+    memory_vms: int
+
+
+class StatReader:
+    """Read ``/proc/<pid>/stat`` for processes.
+
+    The files are kept open between reads, so each read is a single ``pread``.
+    The file descriptor remains bound to the original process,
+    so reads fail once it has exited and been reaped, even if its PID is reused.
+
+    At most `max_open` files are kept open (by default, half the soft limit
+    on open file descriptors), and any further processes are read without
+    keeping their file open.
+    """
+
+    def __init__(self, max_open: Optional[int] = None) -> None:
+        self._fds: dict[int, int] = {}
+        if max_open is None:
+            soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft_limit == resource.RLIM_INFINITY:
+                soft_limit = 1024
+            max_open = soft_limit // 2
+        self.max_open = max_open
+
+    def read(self, pid: int) -> ProcStat:
+        """Read the current statistics for a process.
+
+        :raises psutil.NoSuchProcess: if the process does not exist
+        """
+        fd = self._fds.get(pid)
+        try:
+            if fd is not None:
+                data = os.pread(fd, 4096, 0)
+            elif len(self._fds) < self.max_open:
+                fd = self._fds[pid] = os.open(f"/proc/{pid}/stat", os.O_RDONLY)
+                data = os.pread(fd, 4096, 0)
+            else:
+                with open(f"/proc/{pid}/stat", "rb") as handle:
+                    data = handle.read()
+        except (FileNotFoundError, ProcessLookupError):
+            self.close(pid)
+            raise psutil.NoSuchProcess(pid) from None
+        return parse_stat(data)
+
+    def close(self, pid: Optional[int] = None) -> None:
+        """Close the file for a process, or for all processes if `pid` is None."""
+        pids = list(self._fds) if pid is None else [pid]
+        for _pid in pids:
+            fd = self._fds.pop(_pid, None)
+            if fd is not None:
+                os.close(fd)
+
+
+def descendants(root_pid: int) -> list[int]:
+    """Find the PIDs of all descendants of a process.
+
+    This reads the parent PID of every process from ``/proc/<pid>/stat``,
+    in a single pass over ``/proc``.
+    """
+    children: dict[int, list[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "rb") as handle:
+                data = handle.read()
+        except (FileNotFoundError, ProcessLookupError):
+            # the process exited during the scan
+            continue
+        # fields after the command name are: state, ppid, ...
+        ppid = int(data[data.rindex(b")") + 2 :].split(maxsplit=2)[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    pids: list[int] = []
+    parents = [root_pid]
+    while parents:
+        for pid in children.get(parents.pop(), []):
+            pids.append(pid)
+            parents.append(pid)
+    return pids
+
+
+def parse_stat(data: bytes) -> ProcStat:
+    """Parse the content of ``/proc/<pid>/stat``, see ``man 5 proc``."""
+    # the command name (field 2) may contain spaces or parentheses,
+    # so split from the last closing parenthesis, i.e. fields[0] is field 3
+    fields = data[data.rindex(b")") + 2 :].split()
+    return ProcStat(
+        state=fields[0].decode(),
+        cpu_time_user=int(fields[11]) / CLOCK_TICKS,
+        cpu_time_sys=int(fields[12]) / CLOCK_TICKS,
+        num_threads=int(fields[17]),
+        memory_rss=int(fields[21]) * PAGE_SIZE,
+        memory_vms=int(fields[20]),
+    )
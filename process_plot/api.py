@@ -1,20 +1,27 @@
 """Code for profiling a process."""
 
 from collections.abc import Sequence
+from contextlib import suppress
 import json
 import os
 from os import PathLike
+import select
+import sys
 from textwrap import indent
 import time
-from typing import Optional, TextIO, Union
+from typing import TYPE_CHECKING, NamedTuple, Optional, TextIO, Union
 
-from matplotlib.axes import Axes
-import matplotlib.pyplot as plt
-import pandas as pd
 import psutil
 
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
+
 POSIX = os.name == "posix"
 WINDOWS = os.name == "nt"
+LINUX = sys.platform.startswith("linux")
+
+if LINUX:
+    from . import _procfs
 
 COLUMNS_DESCRIPT = (
     ("type", "main or child"),
@@ -24,7 +31,7 @@ COLUMNS_DESCRIPT = (
     ("cpu_time_sys_secs", "Time spent executing in kernel mode"),
     (
         "cpu_percent",
-        "Percentage of process times to system CPU times elapsed since last call",
+        "Percentage of process CPU times to wall-clock time elapsed since last poll",
     ),
     ("threads_num", "Number of threads currently used"),
     ("memory_rss_bytes", "Resident Set Size; the non-swapped physical memory used"),
@@ -33,6 +40,25 @@ COLUMNS_DESCRIPT = (
 )
 
 
+# the maximum size of output (in characters) to buffer between writes
+_WRITE_BUFFER_SIZE = 64 * 1024
+
+# the format of each column in the output stream
+_COLUMN_FORMATS = {
+    "type": "s",
+    "pid": "d",
+    "elapsed_secs": ".6f",
+    "cpu_time_user_secs": ".6f",
+    "cpu_time_sys_secs": ".6f",
+    "cpu_percent": ".2f",
+    "threads_num": "d",
+    "memory_rss_bytes": "d",
+    "memory_vms_bytes": "d",
+    # only available for the main process, so commonly "-"
+    "files_num": "s",
+}
+
+
 def profile_process(
     pid: int,
     *,
@@ -47,6 +73,8 @@ def profile_process(
     write_metadata: bool = True,
     command_list: Optional[list[str]] = None,
     title: Optional[str] = None,
+    write_batch: int = 16,
+    children_rescan: int = 1,
 ) -> None:
     """Poll process every `poll_interval` seconds and write system resource usage.
 
@@ -54,14 +82,27 @@ def profile_process(
     :param poll_interval: Poll every n seconds
     :param max_intervals: If not None, stop after this many intervals
     :param output_stream: Stream to write outputs to
-    :param flush_output: Flush the output stream buffer after every write
+    :param flush_output:
+        Write to the output stream, and flush its buffer, after every poll
     :param headers: Write field headers to output stream
     :param output_separator: Separator for fields
     :param output_files_num:
         Output number of file descriptors (unix) or handles (windows) used by process.
         Note, this is a more expensive operation than others.
+    :param write_batch:
+        Number of polls to buffer, before writing to the output stream
+        (or sooner, if the buffered output exceeds 64 KiB).
+        Ignored if `flush_output` is set.
+    :param children_rescan:
+        Rescan the process tree for child processes every n polls
+        (or sooner, if a known child process has exited).
+        Note, this is a more expensive operation than others,
+        but child processes that start and exit between scans are not recorded.
 
     """
+    if write_batch < 1:
+        raise ValueError(f"write_batch must be at least 1: {write_batch}")
+
     col_headers = [name for name, _ in COLUMNS_DESCRIPT]
     if output_files_num:
         assert POSIX or WINDOWS, "output_files_num only supported on posix and windows"
@@ -84,6 +125,12 @@ def profile_process(
             indent(json.dumps(metadata, indent=2), "# ", lambda s: True) + "\n"
         )
 
+    # a format template for rows, specialised to the output columns
+    col_formats = [_COLUMN_FORMATS[name] for name in col_headers]
+    row_format = output_separator.replace("%", "%%").join(
+        f"%{spec}" for spec in col_formats
+    )
+
     if headers and output_stream is not None:
         output_stream.write(output_separator.join(col_headers) + "\n")
         if flush_output:
@@ -91,71 +138,265 @@ def profile_process(
 
     iteration = 0
     proc = psutil.Process(pid)
-    while True:
-        iteration += 1
-
-        elapsed_time = time.time() - proc.create_time()
-        try:
-            if not proc.is_running() or proc.status() == "zombie":
-                raise psutil.NoSuchProcess(proc.pid)
-            attrs = ["pid", "cpu_times", "cpu_percent", "num_threads", "memory_info"]
-            data = proc.as_dict(attrs=attrs)
-            data["is_main"] = True
-            if child_processes:
-                child_data = [
-                    p.as_dict(attrs=attrs) for p in proc.children(recursive=True)
-                ]
-            else:
-                child_data = []
-        except psutil.NoSuchProcess:
-            break
-        if output_files_num:
+    create_time = proc.create_time()
+    # schedule polls against a monotonic deadline, so time spent sampling
+    # does not accumulate as drift in the poll interval
+    next_time = time.monotonic()
+    # where supported, wait on a pidfd, so that we stop as soon as the process exits
+    pidfd = _open_pidfd(pid)
+    output_rows: list[str] = []
+    output_size = 0
+    children: dict[int, psutil.Process] = {}
+    children_scanned = 0
+    # (monotonic time, total CPU time) at the last poll, for each process
+    cpu_totals: dict[int, tuple[float, float]] = {}
+    stat_reader = _procfs.StatReader() if LINUX else None
+    try:
+        while True:
+            iteration += 1
+
+            elapsed_time = time.time() - create_time
+            now = time.monotonic()
             try:
-                if POSIX:
-                    data["num_files"] = proc.num_fds()
-                elif WINDOWS:
-                    data["num_files"] = proc.num_handles()  # type: ignore[attr-defined]
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                # this was happening on linux with num_fds call
-                pass
+                main_sample = _sample(proc, now, cpu_totals, stat_reader)
+                if main_sample.zombie:
+                    break
+                num_files = None
+                if output_files_num:
+                    try:
+                        if POSIX:
+                            num_files = proc.num_fds()
+                        elif WINDOWS:
+                            num_files = proc.num_handles()  # type: ignore[attr-defined]
+                    except (psutil.NoSuchProcess, psutil.AccessDenied):
+                        # this was happening on linux with num_fds call
+                        pass
+                child_samples = []
+                if child_processes:
+                    if (
+                        not children_scanned
+                        or iteration - children_scanned >= children_rescan
+                    ):
+                        children = _scan_children(
+                            proc, children, cpu_totals, stat_reader
+                        )
+                        children_scanned = iteration
+                    for child in list(children.values()):
+                        try:
+                            child_samples.append(
+                                _sample(child, now, cpu_totals, stat_reader)
+                            )
+                        except psutil.NoSuchProcess:  # noqa: PERF203
+                            # force a rescan on the next poll
+                            del children[child.pid]
+                            cpu_totals.pop(child.pid, None)
+                            children_scanned = 0
+            except psutil.NoSuchProcess:
+                break
 
+            if output_stream is not None:
+                for sample in (main_sample, *child_samples):
+                    is_main = sample is main_sample
+                    # in the order of COLUMNS_DESCRIPT
+                    values: tuple[Union[str, int, float, None], ...] = (
+                        "main" if is_main else "child",
+                        sample.pid,
+                        elapsed_time,
+                        sample.cpu_time_user,
+                        sample.cpu_time_sys,
+                        sample.cpu_percent,
+                        sample.threads_num,
+                        sample.memory_rss,
+                        sample.memory_vms,
+                    )
+                    if output_files_num:
+                        values += (
+                            num_files if is_main and num_files is not None else "-",
+                        )
+                    if None in values:
+                        row = output_separator.join(
+                            _format_value(value, spec)
+                            for value, spec in zip(values, col_formats)
+                        )
+                    else:
+                        row = row_format % values
+                    output_rows.append(row)
+                    output_size += len(row) + 1
+                if (
+                    flush_output
+                    or iteration % write_batch == 0
+                    or output_size >= _WRITE_BUFFER_SIZE
+                ):
+                    _write_rows(output_stream, output_rows, flush_output)
+                    output_size = 0
+
+            if max_iterations is not None and iteration >= max_iterations:
+                raise TimeoutError("Max iterations reached")
+
+            next_time += poll_interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                if pidfd is None:
+                    time.sleep(delay)
+                elif _wait_for_exit(pidfd, delay):
+                    break
+            else:
+                # the poll overran the interval, so restart the schedule from now,
+                # rather than polling repeatedly to catch up
+                next_time = time.monotonic()
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+        if stat_reader is not None:
+            stat_reader.close()
         if output_stream is not None:
-            for item in [data, *child_data]:
-                results = {
-                    "pid": item["pid"],
-                    "type": "main" if item.get("is_main") else "child",
-                    "elapsed_secs": elapsed_time,
-                    "cpu_time_user_secs": "-"
-                    if item["cpu_times"] is None
-                    else item["cpu_times"].user,
-                    "cpu_time_sys_secs": "-"
-                    if item["cpu_times"] is None
-                    else item["cpu_times"].system,
-                    "cpu_percent": "-"
-                    if item["cpu_percent"] is None
-                    else item["cpu_percent"],
-                    "threads_num": "-"
-                    if item["num_threads"] is None
-                    else item["num_threads"],
-                    "memory_rss_bytes": "-"
-                    if item["memory_info"] is None
-                    else item["memory_info"].rss,
-                    "memory_vms_bytes": "-"
-                    if item["memory_info"] is None
-                    else item["memory_info"].vms,
-                    "files_num": item.get("num_files", "-"),
-                }
-                output_stream.write(
-                    output_separator.join(str(results[name]) for name in col_headers)
-                    + "\n"
-                )
-            if flush_output:
-                output_stream.flush()
-
-        if max_iterations is not None and iteration >= max_iterations:
-            raise TimeoutError("Max iterations reached")
-
-        time.sleep(poll_interval)
+            _write_rows(output_stream, output_rows, flush_output)
+
+
+# the attributes sampled via psutil (when not reading procfs)
+_PSUTIL_ATTRS = ("status", "cpu_times", "num_threads", "memory_info")
+
+
+class _Sample(NamedTuple):
+    """Resource usage of a process, at a single poll."""
+
+    pid: int
+    zombie: bool
+    cpu_time_user: Optional[float]
+    cpu_time_sys: Optional[float]
+    cpu_percent: Optional[float]
+    threads_num: Optional[int]
+    memory_rss: Optional[int]
+    memory_vms: Optional[int]
+
+
+def _sample(
+    proc: psutil.Process,
+    now: float,
+    cpu_totals: dict[int, tuple[float, float]],
+    stat_reader: "Optional[_procfs.StatReader]",
+) -> _Sample:
+    """Sample the resource usage of a process.
+
+    On Linux (with a `stat_reader`), this is read directly from ``/proc/<pid>/stat``,
+    otherwise it is read via psutil.
+    `cpu_percent` is computed from the CPU time used since the previous sample
+    (0.0 for the first sample), and `cpu_totals` is updated for the next one.
+
+    :raises psutil.NoSuchProcess: if the process no longer exists
+    """
+    if stat_reader is not None:
+        stat = stat_reader.read(proc.pid)
+        sample = _Sample(
+            pid=proc.pid,
+            zombie=stat.state == "Z",
+            cpu_time_user=stat.cpu_time_user,
+            cpu_time_sys=stat.cpu_time_sys,
+            cpu_percent=None,
+            threads_num=stat.num_threads,
+            memory_rss=stat.memory_rss,
+            memory_vms=stat.memory_vms,
+        )
+    else:
+        # as_dict batches the OS API calls for the attributes (via oneshot),
+        # and raises NoSuchProcess if the process has exited
+        data = proc.as_dict(attrs=_PSUTIL_ATTRS)
+        cpu_times = data["cpu_times"]
+        memory_info = data["memory_info"]
+        sample = _Sample(
+            pid=proc.pid,
+            zombie=data["status"] == psutil.STATUS_ZOMBIE,
+            cpu_time_user=None if cpu_times is None else cpu_times.user,
+            cpu_time_sys=None if cpu_times is None else cpu_times.system,
+            cpu_percent=None,
+            threads_num=data["num_threads"],
+            memory_rss=None if memory_info is None else memory_info.rss,
+            memory_vms=None if memory_info is None else memory_info.vms,
+        )
+
+    if sample.cpu_time_user is None or sample.cpu_time_sys is None:
+        return sample
+    cpu_total = sample.cpu_time_user + sample.cpu_time_sys
+    previous = cpu_totals.get(proc.pid)
+    cpu_totals[proc.pid] = (now, cpu_total)
+    cpu_percent = 0.0
+    if previous is not None and now > previous[0]:
+        cpu_percent = (cpu_total - previous[1]) / (now - previous[0]) * 100
+    return sample._replace(cpu_percent=cpu_percent)
+
+
+def _format_value(value: Union[str, int, float, None], format_spec: str) -> str:
+    """Format a value for the output stream, with missing values as "-"."""
+    return "-" if value is None else format(value, format_spec)
+
+
+def _scan_children(
+    proc: psutil.Process,
+    known: dict[int, psutil.Process],
+    cpu_totals: dict[int, tuple[float, float]],
+    stat_reader: "Optional[_procfs.StatReader]",
+) -> dict[int, psutil.Process]:
+    """Scan for all descendants of the process.
+
+    `Process` instances are reused for known children,
+    so that they retain their state between polls (e.g. for `cpu_percent`).
+    For known children that have exited, or whose PID has been reused,
+    the CPU totals are dropped and their stat file is closed.
+
+    On Linux, the process tree is read directly from procfs,
+    and only new children are looked up via psutil.
+    A reused PID is then detected when its stats are next read.
+    """
+    children = {}
+    if LINUX:
+        for pid in _procfs.descendants(proc.pid):
+            if pid in known:
+                children[pid] = known[pid]
+                continue
+            # the process may have exited since the scan
+            with suppress(psutil.NoSuchProcess):
+                children[pid] = psutil.Process(pid)
+    else:
+        for child in proc.children(recursive=True):
+            previous = known.get(child.pid)
+            children[child.pid] = previous if previous == child else child
+
+    for pid, previous in known.items():
+        if children.get(pid) is not previous:
+            cpu_totals.pop(pid, None)
+            if stat_reader is not None:
+                stat_reader.close(pid)
+    return children
+
+
+def _write_rows(output_stream: TextIO, rows: list[str], flush: bool) -> None:
+    """Write the buffered rows to the output stream, and clear the buffer."""
+    if rows:
+        output_stream.write("\n".join(rows) + "\n")
+        rows.clear()
+    if flush:
+        output_stream.flush()
+
+
+def _open_pidfd(pid: int) -> Optional[int]:
+    """Open a file descriptor referring to the process, if supported (Linux >= 5.3)."""
+    if not LINUX:
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        # os.pidfd_open requires Python >= 3.9, and Linux >= 5.3
+        return None
+
+
+def _wait_for_exit(pidfd: int, timeout: float) -> bool:
+    """Wait up to `timeout` seconds for the process to exit.
+
+    :returns: True if the process exited
+    """
+    poller = select.poll()
+    poller.register(pidfd, select.POLLIN)
+    return bool(poller.poll(timeout * 1000))
 
 
 PLOT_YLABELS: Sequence[tuple[str, str]] = (
@@ -168,11 +409,34 @@ PLOT_YLABELS: Sequence[tuple[str, str]] = (
     ("files_num", "# files"),
 )
 
+_MB_PER_BYTE = 1 / (1024 * 1024)
+
 _convert_column_names = {
     "cpu_time_user_secs": "cpu_time_user",
     "cpu_time_sys_secs": "cpu_time_sys",
 }
 
+# the output stream columns needed for each plot column (if not the same name)
+_plot_column_sources = {
+    "memory_rss": "memory_rss_bytes",
+    "memory_vms": "memory_vms_bytes",
+    **{v: k for k, v in _convert_column_names.items()},
+}
+
+# missing values are written as "-", so these must all be nullable
+_column_dtypes = {
+    "type": "category",
+    "pid": "int32",
+    "elapsed_secs": "float64",
+    "cpu_time_user_secs": "float32",
+    "cpu_time_sys_secs": "float32",
+    "cpu_percent": "float32",
+    "threads_num": "float32",
+    "memory_rss_bytes": "float64",
+    "memory_vms_bytes": "float64",
+    "files_num": "float32",
+}
+
 
 def plot_result(
     inpath: PathLike[str],
@@ -190,32 +454,60 @@ def plot_result(
 
     :returns: True if successful, False if no data to plot
     """
-    df = pd.read_csv(inpath, na_values="-", comment="#").set_index("elapsed_secs")
+    # imported here, since they are slow to import and not needed for profiling
+    from matplotlib.figure import Figure
+    import pandas as pd
+
+    usecols = {"type", "pid", "elapsed_secs"}
+    usecols.update(_plot_column_sources.get(column, column) for column in columns)
+    df = pd.read_csv(
+        inpath,
+        na_values="-",
+        comment="#",
+        usecols=lambda name: name in usecols,
+        dtype=_column_dtypes,
+    ).set_index("elapsed_secs")
     if not df.shape[0]:
         return False
 
-    df["memory_rss"] = df["memory_rss_bytes"] / (1024 * 1024)
-    df["memory_vms"] = df["memory_vms_bytes"] / (1024 * 1024)
-    df["Process"] = df.apply(
-        lambda row: f"{row['type'].capitalize()} ({row['pid']})", axis=1
-    )
-    # TODO sort so main process is always on top
+    # replace the bytes columns, rather than keeping copies of them
+    for name in ("memory_rss", "memory_vms"):
+        if name not in columns:
+            continue
+        df[name] = df.pop(f"{name}_bytes").to_numpy(dtype="float32") * _MB_PER_BYTE
     df.rename(_convert_column_names, axis=1, inplace=True)
 
-    axes: list[Axes]
-    fig, axes = plt.subplots(nrows=len(columns), sharex=True)
-    if len(columns) == 1:
-        axes = [axes]  # type: ignore[list-item]
+    times = df.index.unique().sort_values()
+    processes = []
+    if stack_processes:
+        # TODO sort so main process is always on top
+        labels = df["type"].str.capitalize() + " (" + df["pid"].astype(str) + ")"
+        processes = list(df.groupby(labels, sort=False, observed=True))
+
+    # create the figure directly (rather than via pyplot),
+    # so it is not kept in pyplot's global figure registry after saving
+    fig = Figure()
+    axes: list[Axes] = list(
+        fig.subplots(nrows=len(columns), sharex=True, squeeze=False)[:, 0]
+    )
 
-    for i, column in enumerate(columns):
-        data = df.pivot(columns="Process", values=column)
+    for ax, column in zip(axes, columns):
         if stack_processes:
-            data.sort_values(by=data.index[-1], axis=1, ascending=False).plot.area(
-                ax=axes[i], grid=grid, stacked=True, legend=False
+            stacks = [
+                (label, group[column].reindex(times, fill_value=0).fillna(0))
+                for label, group in processes
+            ]
+            stacks.sort(key=lambda stack: stack[1].iloc[-1], reverse=True)
+            ax.stackplot(
+                times,
+                *(values.to_numpy() for _, values in stacks),
+                labels=[label for label, _ in stacks],
             )
         else:
-            data.sum(axis=1).plot(ax=axes[i], grid=grid, legend=False)
-        axes[i].set_ylabel(dict(PLOT_YLABELS)[column])
+            total = df[column].groupby(level=0).sum()
+            ax.plot(total.index, total.to_numpy())
+        ax.grid(grid)
+        ax.set_ylabel(dict(PLOT_YLABELS)[column])
 
     axes[-1].set_xlabel("Elapsed Time (s)")
 
@@ -13,14 +13,12 @@ import sys
 import time
 from typing import Annotated, Optional, Union
 
-try:
+if sys.version_info >= (3, 10):
     from typing import TypeAlias
-except ImportError:
-    # added in python 3.10
+else:
     from typing_extensions import TypeAlias
 
 from rich import print as echo
-from rich.table import Table
 import typer
 
 from . import __version__
@@ -43,6 +41,8 @@ def version_callback(value: bool) -> None:
 def columns_callback(value: bool) -> None:
     """Print the available columns and exit"""
     if value:
+        from rich.table import Table
+
         table = Table(show_header=True)
         table.add_column("Name")
         table.add_column("Description")
@@ -171,6 +171,12 @@ def cmd_exec(
         ),
     ] = None,
     child: Annotated[bool, typer.Option(help="Collect child process data")] = True,
+    child_rescan: Annotated[
+        int,
+        typer.Option(
+            help="Rescan for child processes every n polls", min=1, show_default=True
+        ),
+    ] = 1,
     command_output: Annotated[
         CmdOutput,
         typer.Option(
@@ -224,8 +230,8 @@ def cmd_exec(
         stdout_context = nullcontext(sys.stdout)  # type: ignore[assignment]
         stderr_context = nullcontext(sys.stderr)  # type: ignore[assignment]
     elif command_output == CmdOutput.hide:
-        stdout_context = open(os.devnull, "w")
-        stderr_context = open(os.devnull, "w")
+        stdout_context = nullcontext(subprocess.DEVNULL)  # type: ignore[assignment]
+        stderr_context = nullcontext(subprocess.DEVNULL)  # type: ignore[assignment]
     elif command_output == CmdOutput.file:
         stdout_context = open(outfolder / f"{basename}.out.log", "w")
         stderr_context = open(outfolder / f"{basename}.err.log", "w")
@@ -233,7 +239,9 @@ def cmd_exec(
         raise ValueError(f"Unknown command output mode: {command_output}")
 
     output_path = outfolder / f"{basename}.csv"
-    output_context = open(output_path, "w")
+    # the command writes its stdout/stderr straight to the file descriptors,
+    # so this is the only file we write via python buffers
+    output_context = open(output_path, "w", buffering=64 * 1024)
 
     max_iterations = None
     if timeout:
@@ -259,6 +267,7 @@ def cmd_exec(
                         proc.pid,
                         command_list=command_list,
                         child_processes=child,
+                        children_rescan=child_rescan,
                         poll_interval=interval,
                         max_iterations=max_iterations,
                         output_stream=output_stream,
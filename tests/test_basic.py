@@ -1,11 +1,22 @@
 from io import StringIO
 import os
+import statistics
+import subprocess
+import sys
+import time
 from traceback import print_exception
 
+import psutil
 import pytest
 from typer.testing import CliRunner
 
-from process_plot.api import COLUMNS_DESCRIPT, PLOT_YLABELS, profile_process
+from process_plot.api import (
+    COLUMNS_DESCRIPT,
+    LINUX,
+    PLOT_YLABELS,
+    plot_result,
+    profile_process,
+)
 from process_plot.cli import main
 
 
@@ -26,6 +37,216 @@ def test_profile_process():
     assert output_lines[0] == ",".join(dict(COLUMNS_DESCRIPT))
 
 
+def test_profile_process_flush_output():
+    """Test that every poll is written and flushed, when flush_output is set"""
+
+    class FlushStream(StringIO):
+        def __init__(self) -> None:
+            super().__init__()
+            self.flushed: list[int] = []
+
+        def flush(self) -> None:
+            self.flushed.append(len(self.getvalue().splitlines()))
+            super().flush()
+
+    output_stream = FlushStream()
+    with pytest.raises(TimeoutError):
+        profile_process(
+            os.getpid(),
+            poll_interval=0.01,
+            max_iterations=3,
+            output_stream=output_stream,
+            flush_output=True,
+            write_metadata=False,
+            write_batch=16,
+        )
+    assert output_stream.flushed[:4] == [1, 2, 3, 4]
+
+
+@pytest.mark.skipif(not LINUX, reason="pidfd is only available on Linux")
+def test_profile_process_exit():
+    """Test that profiling returns soon after the process exits,
+    rather than waiting for the full poll interval.
+    """
+    process = subprocess.Popen(["sleep", "0.2"])
+    start = time.monotonic()
+    try:
+        profile_process(process.pid, poll_interval=5, write_metadata=False)
+    finally:
+        process.wait()
+    assert time.monotonic() - start < 2.5
+
+
+def test_profile_process_children():
+    """Test that child processes are found and recorded"""
+    process = subprocess.Popen(["sh", "-c", "sleep 1 & wait"])
+    output_stream = StringIO()
+    try:
+        profile_process(
+            process.pid,
+            poll_interval=0.1,
+            output_stream=output_stream,
+            write_metadata=False,
+        )
+    finally:
+        process.wait()
+    types = [line.split(",")[0] for line in output_stream.getvalue().splitlines()]
+    assert "main" in types
+    assert "child" in types
+
+
+@pytest.mark.parametrize("procfs", [True, False], ids=["procfs", "psutil"])
+def test_profile_process_cpu_percent(procfs, monkeypatch):
+    """Test cpu_percent for a CPU-busy child process"""
+    if procfs and not LINUX:
+        pytest.skip("procfs is only available on Linux")
+    monkeypatch.setattr("process_plot.api.LINUX", procfs)
+    busy = (
+        "import time\nend = time.monotonic() + 1.5\nwhile time.monotonic() < end: pass"
+    )
+    process = subprocess.Popen(["sh", "-c", f'"{sys.executable}" -c "{busy}" & wait'])
+    output_stream = StringIO()
+    try:
+        profile_process(
+            process.pid,
+            poll_interval=0.2,
+            output_stream=output_stream,
+            write_metadata=False,
+        )
+    finally:
+        process.wait()
+    header, *lines = output_stream.getvalue().splitlines()
+    columns = header.split(",")
+    samples: dict[tuple[str, str], list[float]] = {}
+    for line in lines:
+        row = dict(zip(columns, line.split(",")))
+        samples.setdefault((row["type"], row["pid"]), []).append(
+            float(row["cpu_percent"])
+        )
+    for values in samples.values():
+        assert values[0] == 0.0
+    (child_values,) = (v for (type_, _), v in samples.items() if type_ == "child")
+    # the last sample may be cut short by the process exiting
+    assert len(child_values) >= 4
+    assert statistics.median(child_values[1:-1]) == pytest.approx(100, abs=20)
+
+
+def test_scan_children_cpu_totals(monkeypatch):
+    """Test that CPU totals are dropped for children that have exited,
+    or whose PID has been reused by a new process.
+    """
+    from process_plot.api import _scan_children
+
+    monkeypatch.setattr("process_plot.api.LINUX", False)
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    process = subprocess.Popen(["sh", "-c", "sleep 1 & sleep 1 & wait"])
+    try:
+        time.sleep(0.2)
+        proc = psutil.Process(process.pid)
+        kept, replaced = proc.children()
+        # a different process, cached under the PID of the second child
+        stale = psutil.Process(os.getpid())
+        known = {kept.pid: kept, replaced.pid: stale, exited.pid: stale}
+        cpu_totals = {pid: (0.0, 1.0) for pid in known}
+        children = _scan_children(proc, known, cpu_totals, None)
+    finally:
+        process.wait()
+    assert children[kept.pid] is kept
+    assert children[replaced.pid] is not stale
+    assert children[replaced.pid] == replaced
+    assert cpu_totals == {kept.pid: (0.0, 1.0)}
+
+
+@pytest.mark.skipif(not LINUX, reason="procfs is only available on Linux")
+def test_profile_process_children_fd_limit():
+    """Test profiling more child processes than the limit on open files"""
+    import resource
+
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (64, hard_limit))
+    try:
+        process = subprocess.Popen(
+            ["sh", "-c", "for i in $(seq 80); do sleep 1 & done; wait"]
+        )
+        output_stream = StringIO()
+        try:
+            profile_process(
+                process.pid,
+                poll_interval=0.2,
+                output_stream=output_stream,
+                write_metadata=False,
+            )
+        finally:
+            process.wait()
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft_limit, hard_limit))
+    child_pids = {
+        line.split(",")[1]
+        for line in output_stream.getvalue().splitlines()
+        if line.startswith("child,")
+    }
+    assert len(child_pids) >= 80
+
+
+@pytest.mark.skipif(not LINUX, reason="procfs is only available on Linux")
+def test_procfs_parse_stat():
+    """Test parsing /proc/<pid>/stat, with a command name containing spaces"""
+    from process_plot._procfs import CLOCK_TICKS, PAGE_SIZE, parse_stat
+
+    data = (
+        b"123 (my (cmd) x) S 1 123 123 0 -1 4194560 500 0 0 0 "
+        + f"{CLOCK_TICKS * 2} {CLOCK_TICKS} ".encode()
+        + b"0 0 20 0 3 0 100 4096000 10 18446744073709551615\n"
+    )
+    stat = parse_stat(data)
+    assert stat.state == "S"
+    assert stat.cpu_time_user == 2
+    assert stat.cpu_time_sys == 1
+    assert stat.num_threads == 3
+    assert stat.memory_vms == 4096000
+    assert stat.memory_rss == 10 * PAGE_SIZE
+
+
+@pytest.mark.skipif(not LINUX, reason="procfs is only available on Linux")
+def test_procfs_descendants():
+    """Test finding descendant processes, against psutil"""
+    from process_plot._procfs import descendants
+
+    process = subprocess.Popen(["sh", "-c", "sleep 1 & sleep 1 & wait"])
+    try:
+        time.sleep(0.2)
+        expected = psutil.Process(process.pid).children(recursive=True)
+        assert len(expected) == 2
+        assert sorted(descendants(process.pid)) == sorted(p.pid for p in expected)
+    finally:
+        process.wait()
+
+
+def test_plot_result_stacked(tmp_path):
+    """Test plotting stacked processes, with a child appearing partway through"""
+    inpath = tmp_path / "output.csv"
+    inpath.write_text(
+        "# {}\n"
+        + ",".join(dict(COLUMNS_DESCRIPT))
+        + "\n"
+        + "main,1,0.1,0.01,0.00,0.00,1,1000000,2000000,3\n"
+        + "main,1,0.2,0.02,0.01,10.00,1,1500000,2000000,3\n"
+        + "child,2,0.2,0.00,0.00,0.00,1,500000,1000000,-\n"
+        + "main,1,0.3,0.03,0.01,20.00,2,1500000,2000000,-\n"
+        + "child,2,0.3,0.01,0.00,5.00,1,700000,1000000,-\n"
+    )
+    outpath = tmp_path / "output.png"
+    assert plot_result(
+        inpath,
+        outpath,
+        columns=[name for name, _ in PLOT_YLABELS],
+        stack_processes=True,
+        legend=True,
+    )
+    assert outpath.exists()
+
+
 def test_cli_help():
     """Test the help output"""
     runner = CliRunner()